@@ -18,4 +18,4 @@ docker rm -f maxmind-server 2>/dev/null || true
 docker build -t maxmind-server .
 
 # Run the Docker container
-docker run -d --name maxmind-server --restart unless-stopped -v /opt/container-storage/maxmind:/app/assets -p 127.0.0.1:8000:8000 -e MAXMIND_LICENSE_KEY=${MAXMIND_LICENSE_KEY} maxmind-server
\ No newline at end of file
+docker run -d --name maxmind-server --restart unless-stopped -v /opt/container-storage/maxmind:/app/assets -p 127.0.0.1:8000:8000 -e MAXMIND_LICENSE_KEY=${MAXMIND_LICENSE_KEY} -e TRUSTED_PROXY_HEADER=${TRUSTED_PROXY_HEADER-X-Real-IP} maxmind-server
\ No newline at end of file